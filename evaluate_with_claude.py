@@ -2,30 +2,42 @@
 """
 evaluate_with_claude.py
 
-Reads prompt.md, asks Claude to implement macro_f1, writes code to starter/solution.py,
-runs the grader, and repeats N times. Saves raw/model code per trial for debugging.
+Reads prompt.md, asks Claude to implement macro_f1, writes code to runs/trial_XX/solution.py,
+runs the grader on it, and repeats N times. Trials (API calls and graders) run
+concurrently, bounded by --concurrency. By default each trial is graded in a
+single-use worker forked from a server that has already imported numpy and the
+grader; --grader subprocess starts a fresh interpreter per trial instead. Each
+trial's raw response, extracted code and grader output are appended as one JSON
+line to runs/ledger.jsonl for debugging.
 """
 
 import argparse
+import asyncio
+import hashlib
+import json
+import multiprocessing
 import os
 import re
-import subprocess
 import sys
+import uuid
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
 
-try:
-    import anthropic
-except Exception as e:
-    print("Please install anthropic first: uv pip install anthropic")
-    sys.exit(1)
-
 ROOT = Path(__file__).resolve().parent
 PROMPT_PATH = ROOT / "prompt.md"
-SOLUTION_PATH = ROOT / "starter" / "solution.py"
 GRADER_PATH = ROOT / "grader" / "grade.py"
 RUNS_DIR = ROOT / "runs"
+LEDGER_PATH = RUNS_DIR / "ledger.jsonl"
+CACHE_DIR = ROOT / ".claude_cache"
+
+_CLIENT = None
+# The SDK retries 429/5xx (incl. 529 overloaded) itself, with jittered exponential
+# backoff that honours retry-after; raise its default so rate limits don't cost trials
+MAX_RETRIES = 4
 
-CODE_BLOCK_RE = re.compile(r"```(?:python)?\s*(?P<code>[\s\S]*?)```", re.IGNORECASE)
+CODE_BLOCK_RE = re.compile(r"```(?:python)?\s*(?P<code>[\s\S]*?)```", re.IGNORECASE | re.ASCII)
 
 def read_prompt() -> str:
     base = PROMPT_PATH.read_text(encoding="utf-8")
@@ -46,80 +58,295 @@ def read_prompt() -> str:
 
 def extract_code(text: str) -> str:
     m = CODE_BLOCK_RE.search(text or "")
-    code = m.group("code") if m else (text or "")
-    return code.replace("\r\n", "\n").lstrip("\ufeff").strip()
+    code = m["code"] if m else (text or "")
+    if "\r" in code:
+        code = code.replace("\r\n", "\n").replace("\r", "\n")
+    return code.lstrip("\ufeff").strip()
+
+def make_grader_pool(workers: int) -> ProcessPoolExecutor:
+    # One fresh process per trial (max_tasks_per_child=1), so nothing a candidate does
+    # to module state (e.g. grader.grade.EXPECTED) can leak into the next trial.
+    # Each one is forked from a server that preloaded grader.grade (and numpy). A
+    # worker still re-imports this script as __mp_main__ -- preloading "__main__"
+    # is a no-op for scripts -- which is why anthropic is only imported in
+    # _get_client(). Only offered where forkserver exists (see main()).
+    ctx = multiprocessing.get_context("forkserver")
+    ctx.set_forkserver_preload(["grader.grade"])
+    return ProcessPoolExecutor(max_workers=workers, mp_context=ctx, max_tasks_per_child=1)
+
+async def run_grader_pool(pool: ProcessPoolExecutor, solution_path: Path) -> tuple[int, str, str]:
+    from grader.grade import grade_captured
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(pool, grade_captured, str(solution_path))
 
-def write_solution(code: str) -> None:
-    SOLUTION_PATH.write_text(code, encoding="utf-8")
+async def grader_python_flags() -> tuple[str, ...]:
+    # -I (isolated: no user site, no PYTHON* env) and -B (no .pyc writes) trim every
+    # grader's startup; -S (skip site.py) saves more but also hides site-packages, so
+    # only use it if numpy still imports without it. Probed at most once per run, and
+    # only once a trial actually needs a grader subprocess (see main()).
+    for flags in (("-S", "-I", "-B"), ("-I", "-B")):
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, *flags, "-c", "import numpy",
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+        )
+        if await proc.wait() == 0:
+            return flags
+    return ()
 
-def run_grader() -> subprocess.CompletedProcess:
-    return subprocess.run(
-        [sys.executable, str(GRADER_PATH)],
-        capture_output=True, text=True, cwd=str(ROOT)
+async def run_grader_async(solution_path: Path, flags: tuple[str, ...] = ()) -> tuple[int, str, str]:
+    # Each trial grades its own file, so concurrent graders never race on one path.
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, *flags, str(GRADER_PATH),
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+        cwd=str(ROOT),
+        env={**os.environ, "GRADER_SOLUTION_PATH": str(solution_path)},
     )
+    out, err = await proc.communicate()
+    return proc.returncode, out.decode("utf-8", "replace"), err.decode("utf-8", "replace")
 
-def call_claude(prompt: str, model: str, temperature: float, max_tokens: int) -> str:
-    api_key = os.getenv("ANTHROPIC_API_KEY")
-    if not api_key:
-        raise RuntimeError("ANTHROPIC_API_KEY is not set.")
-    client = anthropic.Anthropic(api_key=api_key)
-    msg = client.messages.create(
+def cache_path(prompt: str, model: str, temperature: float, max_tokens: int, trial: int) -> Path:
+    # temperature 0 is deterministic, so all trials share one entry; otherwise key
+    # on the trial index so each trial stays distinct but a rerun of it is cached
+    key = f"{model}|{temperature}|{max_tokens}|{prompt}"
+    if temperature != 0.0:
+        key += f"|trial={trial}"
+    return CACHE_DIR / f"{hashlib.sha256(key.encode('utf-8')).hexdigest()}.txt"
+
+def write_cache(path: Path, raw: str) -> None:
+    # Write-then-rename so an interrupted run never leaves a truncated entry behind
+    # to be served on every later run
+    CACHE_DIR.mkdir(exist_ok=True)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    tmp.write_text(raw, encoding="utf-8")
+    os.replace(tmp, path)
+
+def _get_client():
+    # One AsyncAnthropic per process: its pooled HTTP connections (keep-alive, TLS)
+    # are shared by every concurrent trial and batch call instead of rebuilt per call
+    # anthropic is imported here, not at module level: grader pool workers re-import
+    # this script and must not pay the SDK's ~1s import on every trial
+    global _CLIENT
+    if _CLIENT is None:
+        import anthropic
+        api_key = os.getenv("ANTHROPIC_API_KEY")
+        if not api_key:
+            raise RuntimeError("ANTHROPIC_API_KEY is not set.")
+        _CLIENT = anthropic.AsyncAnthropic(api_key=api_key, max_retries=MAX_RETRIES)
+    return _CLIENT
+
+def request_params(prompt: str, model: str, temperature: float, max_tokens: int) -> dict:
+    return dict(
         model=model,
         max_tokens=max_tokens,
         temperature=temperature,
         system="Follow the instructions precisely and return only valid Python.",
         messages=[{"role":"user","content": prompt}]
     )
+
+def message_text(msg) -> str:
     parts = [c.text for c in msg.content if getattr(c, "type", "") == "text"]
     return "\n".join(parts).strip()
 
-def main():
+async def call_claude_async(prompt: str, model: str, temperature: float, max_tokens: int,
+                            trial: int, use_cache: bool = True, client=None) -> tuple[str, bool]:
+    # Returns (response text, whether it came from the cache)
+    cached = cache_path(prompt, model, temperature, max_tokens, trial)
+    if use_cache and cached.exists():
+        return cached.read_text(encoding="utf-8"), True
+
+    client = client or _get_client()
+    params = request_params(prompt, model, temperature, max_tokens)
+    msg = await client.messages.create(**params)
+    raw = message_text(msg)
+    if use_cache:
+        write_cache(cached, raw)
+    return raw, False
+
+async def call_claude_batch(prompt: str, model: str, temperature: float, max_tokens: int,
+                            trials: list[int], use_cache: bool = True,
+                            poll_interval: float = 10.0, client=None) -> dict[int, tuple[str, bool] | Exception]:
+    # Submits every uncached trial as one Message Batch (half price, no per-request
+    # rate limiting) and maps each trial to (response text, cached?) or the error it hit.
+    responses: dict[int, tuple[str, bool] | Exception] = {}
+    pending = []
+    for i in trials:
+        cached = cache_path(prompt, model, temperature, max_tokens, i)
+        if use_cache and cached.exists():
+            responses[i] = cached.read_text(encoding="utf-8"), True
+        else:
+            pending.append(i)
+    if not pending:
+        return responses
+
+    client = client or _get_client()
+    requests = [
+        {"custom_id": f"trial_{i:02d}", "params": request_params(prompt, model, temperature, max_tokens)}
+        for i in pending
+    ]
+    batch = await client.messages.batches.create(requests=requests)
+    print(f"Submitted batch {batch.id} with {len(pending)} requests; polling every {poll_interval:g}s")
+    while batch.processing_status != "ended":
+        await asyncio.sleep(poll_interval)
+        batch = await client.messages.batches.retrieve(batch.id)
+
+    async for entry in await client.messages.batches.results(batch.id):
+        i = int(entry.custom_id.removeprefix("trial_"))
+        if entry.result.type != "succeeded":
+            responses[i] = RuntimeError(f"batch request {entry.result.type}: {getattr(entry.result, 'error', '')}")
+            continue
+        raw = message_text(entry.result.message)
+        if use_cache:
+            write_cache(cache_path(prompt, model, temperature, max_tokens, i), raw)
+        responses[i] = raw, False
+
+    for i in pending:
+        responses.setdefault(i, RuntimeError(f"no result for trial_{i:02d} in batch {batch.id}"))
+    return responses
+
+async def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("-n", "--num_trials", type=int, default=10)
     ap.add_argument("--temperature", type=float, default=0.7)
     ap.add_argument("--model", type=str, default="claude-3-5-sonnet-latest")
     ap.add_argument("--max_tokens", type=int, default=1400)
+    ap.add_argument("--concurrency", type=int, default=8,
+                    help="max number of trials talking to the API at once")
+    ap.add_argument("--cache", dest="use_cache", action=argparse.BooleanOptionalAction, default=None,
+                    help="reuse responses in .claude_cache/ (default: only at --temperature 0, since "
+                         "replaying samples at temperature > 0 would freeze the pass-rate estimate)")
+    # Spawned pool workers (Windows) would pay a full interpreter + numpy start per
+    # trial, same as a subprocess, so the pool is only offered with forkserver
+    graders = ["pool", "subprocess"] if "forkserver" in multiprocessing.get_all_start_methods() else ["subprocess"]
+    ap.add_argument("--grader", choices=graders, default=graders[0],
+                    help="grade each trial in a single-use worker forked from a preloaded server "
+                         "(pool, default where available) or in a fresh interpreter (subprocess)")
+    ap.add_argument("--batch", action="store_true",
+                    help="submit all trials as one Message Batch (50%% cost, slower) and grade when it ends")
     args = ap.parse_args()
+    if args.concurrency < 1:
+        # Semaphore(0) would block every API call forever; a negative one raises
+        ap.error("--concurrency must be at least 1")
+    if args.use_cache is None:
+        args.use_cache = args.temperature == 0.0
+
+    try:
+        _get_client()
+    except ImportError:
+        print("Please install anthropic first: uv pip install anthropic")
+        sys.exit(1)
+    except RuntimeError as e:
+        print(f"API error: {e}")
+        sys.exit(1)
 
     RUNS_DIR.mkdir(exist_ok=True)
     prompt = read_prompt()
+    trials = list(range(1, args.num_trials + 1))
+    sem = asyncio.Semaphore(args.concurrency)
+    grade_workers = os.cpu_count() or 4
+    grade_sem = asyncio.Semaphore(grade_workers)
+    pool = make_grader_pool(grade_workers) if args.grader == "pool" else None
+    flags_probe = None  # started by the first trial that grades in a subprocess
 
-    passes = 0
-    for i in range(1, args.num_trials + 1):
-        trial_dir = RUNS_DIR / f"trial_{i:02d}"
-        trial_dir.mkdir(exist_ok=True)
-        print(f"\n=== Trial {i}/{args.num_trials} ===")
+    # One append-only, line-buffered ledger instead of 3-4 small files per trial.
+    # Each record is written without an await in between, so coroutines never interleave.
+    # The ledger accumulates across runs, so every record carries this run's id.
+    ledger = LEDGER_PATH.open("a", encoding="utf-8", buffering=1)
+    run_id = f"{datetime.now():%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:6]}"
+    print(f"Run {run_id}: recording trials to {LEDGER_PATH.relative_to(ROOT)}")
+
+    def record(i: int, **fields) -> None:
+        ledger.write(json.dumps({"run": run_id, "trial": i, "model": args.model,
+                                 "temperature": args.temperature, **fields}) + "\n")
+
+    if args.batch:
+        responses = await call_claude_batch(prompt, args.model, args.temperature, args.max_tokens,
+                                            trials, use_cache=args.use_cache)
+
+        async def fetch(i: int) -> tuple[str, bool]:
+            if isinstance(responses[i], Exception):
+                raise responses[i]
+            return responses[i]
+    else:
+        async def fetch(i: int) -> tuple[str, bool]:
+            async with sem:
+                return await call_claude_async(prompt, args.model, args.temperature, args.max_tokens,
+                                               trial=i, use_cache=args.use_cache)
+
+    async def grade_trial(solution_path: Path) -> tuple[int, str, str]:
+        nonlocal pool, flags_probe
+        used = pool
+        if used is not None:
+            try:
+                return await run_grader_pool(used, solution_path)
+            except BrokenProcessPool:
+                # A worker died hard (os._exit, segfault, OOM). That fails every task
+                # in flight, not just the culprit's, so replace the pool and re-grade
+                # this trial in its own interpreter, where a crash only fails itself.
+                if pool is used:
+                    used.shutdown(wait=False, cancel_futures=True)
+                    pool = make_grader_pool(grade_workers)
+        if flags_probe is None:
+            # Shared task, so concurrent trials wait on a single probe
+            flags_probe = asyncio.ensure_future(grader_python_flags())
+        return await run_grader_async(solution_path, await flags_probe)
 
+    async def run_trial(i: int) -> bool:
         try:
-            raw = call_claude(prompt, args.model, args.temperature, args.max_tokens)
+            raw, cached = await fetch(i)
         except Exception as e:
+            print(f"\n=== Trial {i}/{args.num_trials} ===")
             print(f"API error: {e}")
-            (trial_dir / "error.txt").write_text(str(e), encoding="utf-8")
-            continue
-
-        (trial_dir / "raw.txt").write_text(raw, encoding="utf-8")
+            record(i, error=str(e))
+            return False
 
         code = extract_code(raw)
         if "def macro_f1(" not in code:
+            print(f"\n=== Trial {i}/{args.num_trials} ===")
+            if cached:
+                print("(response replayed from .claude_cache/)")
             print("Response did not contain function signature. FAIL.")
-            (trial_dir / "extracted.txt").write_text(code, encoding="utf-8")
-            continue
+            record(i, raw=raw, code=code, cached=cached, error="response did not contain def macro_f1(")
+            return False
+
+        # The grader needs a real file to import; everything else goes to the ledger
+        trial_dir = RUNS_DIR / f"trial_{i:02d}"
+        trial_dir.mkdir(exist_ok=True)
+        solution_path = trial_dir / "solution.py"
+        solution_path.write_text(code, encoding="utf-8")
 
-        (trial_dir / "solution.py").write_text(code, encoding="utf-8")
-        write_solution(code)
+        async with grade_sem:
+            returncode, stdout, stderr = await grade_trial(solution_path)
+        record(i, raw=raw, code=code, cached=cached, grader_stdout=stdout, grader_stderr=stderr,
+               returncode=returncode)
 
-        proc = run_grader()
-        (trial_dir / "grader_stdout.txt").write_text(proc.stdout, encoding="utf-8")
-        if proc.stderr:
-            (trial_dir / "grader_stderr.txt").write_text(proc.stderr, encoding="utf-8")
+        print(f"\n=== Trial {i}/{args.num_trials} ===")
+        if cached:
+            print("(response replayed from .claude_cache/)")
+        print(stdout, end="")
+        if returncode == 0:
+            return True
+        print(f"(See run {run_id}, trial {i} in runs/ledger.jsonl for details)")
+        return False
 
-        print(proc.stdout, end="")
-        if proc.returncode == 0:
-            passes += 1
-        else:
-            print("(See runs/trial_{:02d} for details)".format(i))
+    try:
+        results = await asyncio.gather(
+            *[run_trial(i) for i in trials],
+            return_exceptions=True,
+        )
+        # Anything that escaped run_trial (failed write, grader spawn error, ...)
+        # still counts as a failed trial and must be visible, not silently dropped
+        for i, r in zip(trials, results):
+            if isinstance(r, BaseException):
+                print(f"\n=== Trial {i}/{args.num_trials} ===")
+                print(f"Trial error: {type(r).__name__}: {r}")
+                record(i, error=f"{type(r).__name__}: {r}")
+    finally:
+        ledger.close()
+        if pool is not None:
+            pool.shutdown()
+    passes = sum(1 for r in results if r is True)
 
     print(f"\nPasses: {passes}/{args.num_trials}  =>  Pass-rate: {passes/args.num_trials:.1%}")
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
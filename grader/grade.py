@@ -14,11 +14,17 @@ What this grader enforces:
 NOTE: We allow numpy in candidate solutions again.
 """
 
+import contextlib
+import dis
 import importlib.util
+import inspect
+import io
 import os
 import sys
-from typing import Iterable, Any
+from collections import Counter
+from types import MappingProxyType
 import math
+import traceback
 
 try:
     import numpy as np
@@ -27,47 +33,57 @@ except Exception as e:
     sys.exit(1)
 
 ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-SOLUTION_PATH = os.path.join(ROOT, "starter", "solution.py")
-
-if not os.path.exists(SOLUTION_PATH):
-    print("FAIL: starter/solution.py not found")
-    sys.exit(1)
-
-spec = importlib.util.spec_from_file_location("candidate_solution", SOLUTION_PATH)
-mod = importlib.util.module_from_spec(spec)
-try:
-    spec.loader.exec_module(mod)  # type: ignore
-except Exception as e:
-    print("FAIL: importing solution raised an exception:", e)
-    sys.exit(1)
-
-if not hasattr(mod, "macro_f1"):
-    print("FAIL: solution.py must define a function named macro_f1")
-    sys.exit(1)
-
-macro_f1 = getattr(mod, "macro_f1")
-# --- Style check: macro_f1 must begin with a docstring ---
-try:
-    import inspect, textwrap, ast
-    _src = inspect.getsource(mod.macro_f1)
-    # Parse the function with AST and check first statement
-    _fn_ast = ast.parse(_src).body[0]  # FunctionDef
-    _has_docstring = ast.get_docstring(_fn_ast) is not None and len(ast.get_docstring(_fn_ast).strip()) > 0
-    if not _has_docstring:
+# The evaluator points each grader run at its own trial file; default to the starter.
+SOLUTION_PATH = os.environ.get(
+    "GRADER_SOLUTION_PATH", os.path.join(ROOT, "starter", "solution.py")
+)
+
+# ---------- Candidate loading (import + style checks) ----------
+
+def _has_import(code) -> bool:
+    # Both `import x` and `from x import y` compile to IMPORT_NAME. Nested functions,
+    # lambdas and comprehensions are separate code objects in co_consts.
+    if any(ins.opname == "IMPORT_NAME" for ins in dis.get_instructions(code)):
+        return True
+    return any(_has_import(c) for c in code.co_consts if inspect.iscode(c))
+
+def _load_macro_f1(solution_path):
+    # Returns the candidate's macro_f1, or None after printing why it was rejected
+    if not os.path.exists(solution_path):
+        print(f"FAIL: {solution_path} not found")
+        return None
+
+    spec = importlib.util.spec_from_file_location("candidate_solution", solution_path)
+    mod = importlib.util.module_from_spec(spec)
+    try:
+        spec.loader.exec_module(mod)  # type: ignore
+    except Exception as e:
+        print("FAIL: importing solution raised an exception:", e)
+        return None
+
+    if not hasattr(mod, "macro_f1"):
+        print("FAIL: solution.py must define a function named macro_f1")
+        return None
+
+    macro_f1 = getattr(mod, "macro_f1")
+    # A partial or callable instance would hand us its class's docstring and code
+    if not inspect.isfunction(macro_f1):
+        print("FAIL: macro_f1 must be a function defined with def")
+        return None
+
+    # --- Style check: macro_f1 must begin with a docstring ---
+    # Python already extracted it at def time; no need to re-read and parse the source
+    _doc = macro_f1.__doc__
+    if not isinstance(_doc, str) or not _doc.strip():
         print("FAIL: macro_f1 must start with a docstring describing inputs, outputs, and edge cases.")
-        sys.exit(1)
-except Exception as _e:
-    print("FAIL: unable to inspect macro_f1 source for docstring check:", _e)
-    sys.exit(1)
-    import inspect, textwrap, re
-    _src = inspect.getsource(mod.macro_f1)
-    _body = textwrap.dedent("\n".join(_src.splitlines()[1:]))  # drop "def" line, dedent body
-    if re.search(r'^\s*import\s+\w+|^\s*from\s+\w+\s+import', _body, flags=re.MULTILINE):
+        return None
+
+    # --- Style check: no imports inside macro_f1 ---
+    if _has_import(macro_f1.__code__):
         print("FAIL: imports are not allowed inside macro_f1; place imports at module top.")
-        sys.exit(1)
-except Exception as _e:
-    print("FAIL: unable to inspect macro_f1 source for style checks:", _e)
-    sys.exit(1)
+        return None
+
+    return macro_f1
 
 # ---------- Reference implementation (with generator + NaN handling) ----------
 
@@ -86,35 +102,32 @@ def _normalize_label(x):
     return x
 
 def _materialize(a):
-    # Accept general iterables: convert to list once (handles generators)
-    try:
-        if isinstance(a, (list, tuple, np.ndarray)):
-            return list(a)
-    except Exception:
-        pass
+    # Accept general iterables: one list copy (handles generators, and gives the
+    # candidate its own list so mutations can't leak back into the test data)
     return list(a)
 
-def _macro_f1_ref(y_true: Iterable[Any], y_pred: Iterable[Any]) -> float:
-    # Materialize for safe multiple passes and to support len()
-    yt = _materialize(y_true)
-    yp = _materialize(y_pred)
-
+def _macro_f1_ref(yt: list, yp: list) -> float:
+    # Inputs are the lists run_case already materialized; no further copies here
     if len(yt) != len(yp):
         raise ValueError("y_true and y_pred must have the same length")
 
     yt = [_normalize_label(v) for v in yt]
     yp = [_normalize_label(v) for v in yp]
 
-    classes = sorted(set(yt) | set(yp), key=lambda x: (str(type(x)), str(x)))
+    # One pass per tally: predicted (TP+FP), actual (TP+FN) and true positives
+    pp = Counter(yp)
+    ap = Counter(yt)
+    tp = Counter(a for a,b in zip(yt, yp) if a == b)
+
+    # Macro-F1 is an unweighted mean, so class order does not matter
+    classes = set(pp) | set(ap)
 
     f1s = []
     for c in classes:
-        tp = sum(1 for a,b in zip(yt, yp) if a == c and b == c)
-        fp = sum(1 for a,b in zip(yt, yp) if a != c and b == c)
-        fn = sum(1 for a,b in zip(yt, yp) if a == c and b != c)
+        t, p, a = tp.get(c, 0), pp.get(c, 0), ap.get(c, 0)
 
-        prec = 0.0 if (tp + fp) == 0 else tp / (tp + fp)
-        rec  = 0.0 if (tp + fn) == 0 else tp / (tp + fn)
+        prec = 0.0 if p == 0 else t / p
+        rec  = 0.0 if a == 0 else t / a
         f1   = 0.0 if (prec + rec) == 0 else (2 * prec * rec) / (prec + rec)
         f1s.append(f1)
 
@@ -125,19 +138,20 @@ def _approx_equal(a: float, b: float, tol: float = 1e-9) -> bool:
         return abs(a - b) <= tol
     return False
 
-def _frozen_copy_list(x_list):
-    # x_list is a list (we pass lists to the candidate); copy for mutation check
-    return list(x_list)
+def _snapshot(x_list):
+    # Shallow snapshot for the mutation check, compared element-wise with ==;
+    # a hash alone can't prove nothing changed (hash(-1) == hash(-2) in CPython)
+    return tuple(x_list)
 
 # ---------- Single test runner (materializes before calling candidate) ----------
 
-def run_case(name, y_true, y_pred, expect=None, expect_exception: type | None = None):
+def run_case(macro_f1, name, y_true, y_pred, expect=None, expect_exception: type | None = None):
     # Materialize inputs ONCE (so both candidate and reference see the same data)
     yt = _materialize(y_true)
     yp = _materialize(y_pred)
 
-    yt0 = _frozen_copy_list(yt)
-    yp0 = _frozen_copy_list(yp)
+    yt0 = _snapshot(yt)
+    yp0 = _snapshot(yp)
 
     try:
         out = macro_f1(yt, yp)
@@ -165,11 +179,11 @@ def run_case(name, y_true, y_pred, expect=None, expect_exception: type | None =
         print(f"FAIL:{name}: value mismatch. got={out:.12f}, expected(ref)={ref:.12f}")
         return False
 
-    # Mutation checks: candidate received lists; they must remain equal to snapshots
-    if yt != yt0:
+    # Mutation checks: candidate received lists; they must still match their snapshots
+    if _snapshot(yt) != yt0:
         print(f"FAIL:{name}: y_true was mutated")
         return False
-    if yp != yp0:
+    if _snapshot(yp) != yp0:
         print(f"FAIL:{name}: y_pred was mutated")
         return False
 
@@ -178,53 +192,100 @@ def run_case(name, y_true, y_pred, expect=None, expect_exception: type | None =
 
 # ---------- Test suite ----------
 
-def main():
-    all_ok = True
+# Generator inputs (no __len__): stored as factories so every grade() call
+# in a long-lived process gets fresh, unconsumed generators
+def _gen1():
+    for x in ["a","b","a","c"]:
+        yield x
 
+def _gen2():
+    for x in ["a","a","c","c"]:
+        yield x
+
+_nan = float("nan")
+
+# (name, y_true, y_pred, options for run_case)
+CASES = (
     # Base battery
-    all_ok &= run_case("balanced_3class", ["A","A","B","B","C","C"], ["A","B","B","B","C","A"])
-    all_ok &= run_case("no_pred_for_class", [0,0,1,1,1,2,2], [0,0,1,1,1,0,0])
-    all_ok &= run_case("class_absent_in_truth", [0,0,1,1,1,0,0], [0,0,1,1,1,2,2])
-    all_ok &= run_case("gapped_labels", [0,0,2,2,5,5,5], [0,2,2,5,5,5,0])
-    all_ok &= run_case("string_labels_unseen_pred", ["dog","dog","cat","cat","mouse"], ["dog","cat","cat","mouse","unicorn"])
-    all_ok &= run_case("numpy_arrays", np.array([1,1,2,2,3,3]), np.array([1,2,2,3,3,1]))
-    all_ok &= run_case("perfect", ["x","y","z","x","y","z"], ["x","y","z","x","y","z"], expect=1.0)
-    all_ok &= run_case("all_wrong", [0,1,2], [1,2,0])
+    ("balanced_3class", ["A","A","B","B","C","C"], ["A","B","B","B","C","A"], {}),
+    ("no_pred_for_class", [0,0,1,1,1,2,2], [0,0,1,1,1,0,0], {}),
+    ("class_absent_in_truth", [0,0,1,1,1,0,0], [0,0,1,1,1,2,2], {}),
+    ("gapped_labels", [0,0,2,2,5,5,5], [0,2,2,5,5,5,0], {}),
+    ("string_labels_unseen_pred", ["dog","dog","cat","cat","mouse"], ["dog","cat","cat","mouse","unicorn"], {}),
+    ("numpy_arrays", np.array([1,1,2,2,3,3]), np.array([1,2,2,3,3,1]), {}),
+    ("perfect", ["x","y","z","x","y","z"], ["x","y","z","x","y","z"], {"expect": 1.0}),
+    ("all_wrong", [0,1,2], [1,2,0], {}),
 
     # Length mismatch must raise ValueError
-    all_ok &= run_case("length_mismatch", [0,1,2], [0,1], expect_exception=ValueError)
+    ("length_mismatch", [0,1,2], [0,1], {"expect_exception": ValueError}),
 
     # NaN as label (NaN == NaN); also contains unseen predicted label 'x'
-    nan = float("nan")
-    y_true = [nan, "a", "a", nan, "b"]
-    y_pred = [nan, "a", nan, "x", "b"]
-    all_ok &= run_case("nan_as_label", y_true, y_pred)
+    ("nan_as_label", [_nan, "a", "a", _nan, "b"], [_nan, "a", _nan, "x", "b"], {}),
 
     # Extreme imbalance
-    yt = [0]*98 + [1]*2
-    yp = [0]*99 + [1]
-    all_ok &= run_case("extreme_imbalance", yt, yp)
+    ("extreme_imbalance", [0]*98 + [1]*2, [0]*99 + [1], {}),
 
     # Composite labels
-    y_true = [("A",1), ("A",2), "B", "B", frozenset({1,2})]
-    y_pred = [("A",1), "B", "B", frozenset({2,1}), ("X",9)]
-    all_ok &= run_case("composite_labels", y_true, y_pred)
-
-    # Generator inputs (no __len__)
-    def gen1():
-        for x in ["a","b","a","c"]:
-            yield x
-    def gen2():
-        for x in ["a","a","c","c"]:
-            yield x
-    all_ok &= run_case("generator_inputs", gen1(), gen2())
-
-    if all_ok:
-        print("GRADE:PASS")
-        sys.exit(0)
-    else:
-        print("GRADE:FAIL")
-        sys.exit(1)
+    ("composite_labels",
+     [("A",1), ("A",2), "B", "B", frozenset({1,2})],
+     [("A",1), "B", "B", frozenset({2,1}), ("X",9)], {}),
+
+    ("generator_inputs", _gen1, _gen2, {}),
+)
+
+def _case_inputs(y_true, y_pred):
+    if callable(y_true):
+        return y_true(), y_pred()
+    return y_true, y_pred
+
+# Reference values are a pure function of the fixed inputs: compute them once at
+# import rather than on every grade() call. The read-only view only stops accidental
+# item writes; candidate code shares this process and can still rebind EXPECTED or
+# patch run_case, so trials are kept apart by grading each in its own process.
+EXPECTED = MappingProxyType({
+    name: opts["expect"] if "expect" in opts
+    else _macro_f1_ref(*map(_materialize, _case_inputs(y_true, y_pred)))
+    for name, y_true, y_pred, opts in CASES
+    if "expect_exception" not in opts
+})
+
+def grade(solution_path=SOLUTION_PATH) -> bool:
+    """Run the full battery against the macro_f1 in solution_path; True if every case passes.
+
+    Importable so a long-lived process (e.g. the evaluator's worker pool) can grade
+    many solutions while paying interpreter + numpy startup only once.
+    """
+    macro_f1 = _load_macro_f1(solution_path)
+    if macro_f1 is None:
+        return False
+
+    all_ok = True
+    for name, y_true, y_pred, opts in CASES:
+        y_true, y_pred = _case_inputs(y_true, y_pred)
+        all_ok &= run_case(macro_f1, name, y_true, y_pred,
+                           expect=EXPECTED.get(name), expect_exception=opts.get("expect_exception"))
+
+    print("GRADE:PASS" if all_ok else "GRADE:FAIL")
+    return bool(all_ok)
+
+def grade_captured(solution_path) -> tuple[int, str, str]:
+    """grade() with its output captured, as (returncode, stdout, stderr).
+
+    Matches what running this file as a script returns, for callers that grade in
+    a worker process instead (the evaluator's --grader pool). Lives here rather than
+    in the evaluator so a worker only has to import this module to run it.
+    """
+    out, err = io.StringIO(), io.StringIO()
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+        try:
+            ok = grade(solution_path)
+        except BaseException:  # candidate code may raise anything, incl. SystemExit
+            traceback.print_exc()
+            ok = False
+    return (0 if ok else 1), out.getvalue(), err.getvalue()
+
+def main():
+    sys.exit(0 if grade(SOLUTION_PATH) else 1)
 
 if __name__ == "__main__":
     main()
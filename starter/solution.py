@@ -1,3 +1,22 @@
+import sys
+from collections import Counter
+from operator import eq
+
+_NAN = ("__NAN__",)  # Sentinel for NaN
+
+def _float_types():
+    # Only float types can hold NaN; an exact-type set lookup is cheaper than isinstance.
+    # numpy float scalars can only be in the inputs if numpy is already loaded, so
+    # look it up instead of importing it (solutions must not import numpy)
+    np = sys.modules.get("numpy")
+    if np is None:
+        return {float}
+    return {float, np.float16, np.float32, np.float64, np.longdouble}
+
+def _has_nan(labels):
+    # x == x is False only for NaN; map(eq, ...) keeps the scan in C
+    return not all(map(eq, labels, labels))
+
 def macro_f1(y_true, y_pred):
     """
     Compute macro-averaged F1 score for multi-class classification.
@@ -27,21 +46,21 @@ def macro_f1(y_true, y_pred):
     if len(y_true_list) != len(y_pred_list):
         raise ValueError("y_true and y_pred must have the same length")
     
-    # Helper function to normalize labels (handle NaN)
-    def normalize_label(label):
-        try:
-            if label != label:  # NaN check (NaN != NaN is True)
-                return ("__NAN__",)  # Sentinel for NaN
-        except TypeError:
-            pass
-        return label
+    # Normalize all labels (collapse NaN to a shared sentinel); most inputs
+    # contain no NaN at all, in which case the lists are used as-is
+    if _has_nan(y_true_list) or _has_nan(y_pred_list):
+        ft, nan = _float_types(), _NAN  # NaN != NaN is True
+        y_true_normalized = [nan if type(label) in ft and label != label else label for label in y_true_list]
+        y_pred_normalized = [nan if type(label) in ft and label != label else label for label in y_pred_list]
+    else:
+        y_true_normalized = y_true_list
+        y_pred_normalized = y_pred_list
     
-    # Normalize all labels
-    y_true_normalized = [normalize_label(label) for label in y_true_list]
-    y_pred_normalized = [normalize_label(label) for label in y_pred_list]
-    
-    # Get all unique classes from both arrays
-    classes = set(y_true_normalized) | set(y_pred_normalized)
+    # Tally per-class counts in a single pass over the data
+    pp = Counter(y_pred_normalized)  # predicted positives (TP + FP)
+    ap = Counter(y_true_normalized)  # actual positives (TP + FN)
+    tp = Counter(yt for yt, yp in zip(y_true_normalized, y_pred_normalized) if yt == yp)
+    classes = set(pp) | set(ap)
     
     # Handle empty case
     if len(classes) == 0:
@@ -50,17 +69,11 @@ def macro_f1(y_true, y_pred):
     f1_scores = []
     
     for cls in classes:
-        # Count TP, FP, FN
-        tp = sum(1 for yt, yp in zip(y_true_normalized, y_pred_normalized) 
-                 if yt == cls and yp == cls)
-        fp = sum(1 for yt, yp in zip(y_true_normalized, y_pred_normalized) 
-                 if yt != cls and yp == cls)
-        fn = sum(1 for yt, yp in zip(y_true_normalized, y_pred_normalized) 
-                 if yt == cls and yp != cls)
+        t, p, a = tp[cls], pp[cls], ap[cls]
         
         # Compute precision and recall
-        precision = tp / (tp + fp) if (tp + fp) > 0 else 0.0
-        recall = tp / (tp + fn) if (tp + fn) > 0 else 0.0
+        precision = t / p if p else 0.0
+        recall = t / a if a else 0.0
         
         # Compute F1 score for this class
         if precision + recall == 0: